@@ -45,30 +45,343 @@ import sys
 from os.path import dirname
 import asyncio
 import ssl
+import struct
+from time import monotonic
+from collections import OrderedDict
 
-import dns.message
-import dns.rrset
+import yaml
 import dns.rcode
 
 from superpowers import *
+from superpowers import wire
 
 TTL = 60
 
+# TCP framing: each request and response is prepended with its length.
+LENGTH = struct.Struct('!H')
+
+# Upstream connections are kept open and reused. At most POOL_SIZE idle connections
+# are kept, and a connection which has been idle for IDLE_TIMEOUT seconds is closed
+# rather than reused.
+POOL_SIZE = 4
+IDLE_TIMEOUT = 30
+
+# How long to wait (seconds) for the recursive resolver to connect or answer. A
+# connection is retired after MAX_TIMEOUTS requests in a row have timed out on it.
+UPSTREAM_TIMEOUT = 5
+MAX_TIMEOUTS = 3
+
+# The maximum number of requests which are processed concurrently. Others wait their turn.
+MAX_CONCURRENT = 100
+
+class UpstreamConnection(object):
+    """A persistent TCP (or TLS) connection to the recursive resolver.
+
+    Requests are pipelined: several can be outstanding at the same time, and
+    responses are matched up with requests by the message ID.
+    """
+    def __init__(self, reader, writer, event_loop):
+        self.reader = reader
+        self.writer = writer
+        self.event_loop = event_loop
+        # Futures for outstanding requests, indexed by the (wire format) message ID.
+        self.pending = {}
+        self.closed = False
+        # Once retired the connection closes when there are no outstanding requests.
+        self.retired = False
+        # Requests in a row which have timed out.
+        self.timeouts = 0
+        # Message IDs of requests which timed out. They aren't reused on this connection
+        # until the (late) response turns up, so it can't be mistaken for the response
+        # to some other request.
+        self.abandoned = set()
+        self.last_used = event_loop.time()
+        self.read_task = event_loop.create_task(self.read_responses())
+        return
+
+    def usable(self, msg_id):
+        """Can the connection be used for a request with this message ID?"""
+        if self.closed or self.retired:
+            return False
+        if self.reader.at_eof():
+            # Half closed by the other end.
+            self.close()
+            return False
+        if not self.pending and self.event_loop.time() - self.last_used > IDLE_TIMEOUT:
+            self.close()
+            return False
+        return msg_id not in self.pending and msg_id not in self.abandoned
+
+    async def send(self, request):
+        """Send the request, returning a future for the response."""
+        future = self.event_loop.create_future()
+        self.pending[request[:2]] = future
+        self.last_used = self.event_loop.time()
+        # NOTE: When using TCP the request and response are prepended with
+        # the length of the request/response. The transport coalesces the writes.
+        self.writer.write(LENGTH.pack(len(request)))
+        self.writer.write(request)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            future.cancel()
+            self.close()
+            raise
+        return future
+
+    async def read_responses(self):
+        """Reads responses and hands them off to whoever is waiting for them."""
+        try:
+            while not self.closed:
+                (response_length,) = LENGTH.unpack(await self.reader.readexactly(2))
+                response = await self.reader.readexactly(response_length)
+
+                future = self.pending.pop(response[:2], None)
+                if future is None:
+                    self.abandoned.discard(response[:2])
+                elif not future.done():
+                    future.set_result(response)
+                self.last_used = self.event_loop.time()
+                self.timeouts = 0
+                if self.retired and not self.pending:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self.close()
+        return
+
+    def timed_out(self, msg_id, future):
+        """The request with this message ID has given up waiting for a response."""
+        if self.pending.get(msg_id) is future:
+            del self.pending[msg_id]
+            self.abandoned.add(msg_id)
+        self.timeouts += 1
+        if self.timeouts >= MAX_TIMEOUTS:
+            self.retired = True
+        if self.retired and not self.pending:
+            self.close()
+        return
+
+    def retire(self):
+        """Close the connection once all outstanding requests have been answered."""
+        self.retired = True
+        if not self.pending:
+            self.close()
+        return
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError('Upstream connection closed.'))
+        self.pending = {}
+        return
+
+class TCPConnectionPool(object):
+    """A pool of persistent connections to the recursive resolver."""
+
+    def __init__(self, remote_address, ssl, event_loop, size=POOL_SIZE, port=None):
+        self.remote_address = remote_address
+        self.ssl = ssl
+        self.port = port or (ssl and 853 or 53)
+        self.event_loop = event_loop
+        self.size = size
+        self.idle = asyncio.Queue()
+        return
+
+    async def acquire(self, msg_id):
+        """Returns a connection which can be used for the message ID.
+
+        Stale connections are discarded along the way. If there is no suitable idle
+        connection then a new one is opened.
+        """
+        connection = None
+        skipped = []
+        while not self.idle.empty():
+            candidate = self.idle.get_nowait()
+            if candidate.usable(msg_id):
+                connection = candidate
+                break
+            if not (candidate.closed or candidate.retired):
+                skipped.append(candidate)
+        for candidate in skipped:
+            self.idle.put_nowait(candidate)
+        if connection is None:
+            reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.remote_address, self.port, ssl=self.ssl),
+                    UPSTREAM_TIMEOUT
+                )
+            connection = UpstreamConnection(reader, writer, self.event_loop)
+        return connection
+
+    def release(self, connection):
+        """Returns the connection to the pool, or retires it if the pool is full."""
+        if connection.closed or connection.retired:
+            return
+        if self.idle.qsize() < self.size:
+            self.idle.put_nowait(connection)
+        else:
+            connection.retire()
+        return
+
+    async def query(self, request):
+        """Send the request to the recursive resolver and return the response.
+
+        The connection is returned to the pool as soon as the request has been
+        written, so that other requests can be pipelined on it while we wait. If
+        the connection turns out to have been closed by the other end the request
+        is retried (once) on a different connection.
+        
+        asyncio.TimeoutError is raised if there's no response within UPSTREAM_TIMEOUT
+        seconds.
+        """
+        retries = 1
+        while True:
+            connection = await self.acquire(request[:2])
+            try:
+                future = await connection.send(request)
+            except ConnectionError:
+                if not retries:
+                    raise
+                retries -= 1
+                continue
+            self.release(connection)
+            try:
+                return await asyncio.wait_for(future, UPSTREAM_TIMEOUT)
+            except asyncio.TimeoutError:
+                connection.timed_out(request[:2], future)
+                raise
+            except ConnectionResetError:
+                if not retries:
+                    raise
+                retries -= 1
+
+class ResponseCache(object):
+    """An LRU cache of (wire format) responses from the recursive resolver.
+    
+    Entries expire when the shortest TTL in the response does.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # Indexed by Powers.key. Values are (response, stored, expires) tuples.
+        self.cache = OrderedDict()
+        return
+    
+    def get(self, key):
+        """Returns a copy of the cached response or None.
+        
+        The TTLs in the copy are reduced by the time it has spent in the cache.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        response, stored, expires = entry
+        now = monotonic()
+        if expires <= now:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return wire.age_ttls(response, int(now - stored))
+    
+    def put(self, key, response, ttl):
+        if not self.maxsize or ttl <= 0:
+            return
+        now = monotonic()
+        self.cache[key] = (response, now, now + ttl)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return
+
 class SuperUDPListener(asyncio.DatagramProtocol):
     """Here's where we get our superpowers by intermediating PTR requests."""
     
     def __init__(self):
         asyncio.DatagramProtocol.__init__(self)
         self.config = None
+        self.workers = asyncio.Semaphore(MAX_CONCURRENT)
+        # Upstream queries in progress, indexed by question.
+        self.inflight = {}
+        # Wire format fallback PTR answers, indexed by FQDN.
+        self.fallback_answers = {}
         return
     
     def connection_made(self, transport):
         self.transport = transport
         return
+    
+    def configure(self, yaml_config):
+        """(Re)configure using the (preprocessed) YAML config.
+        
+        Superpowers which have already been loaded are reused if their parameters
+        haven't changed.
+        """
+        previous = self.config
+        self.config = Config(yaml_config, self.event_loop)
+        if previous is not None:
+            if previous.config['params'] == yaml_config['params']:
+                self.config.powers = previous.powers
+            else:
+                for power in previous.powers.values():
+                    power.close()
+        if previous is None or previous.cache_size != self.config.cache_size:
+            self.cache = ResponseCache(self.config.cache_size)
+        return
+
+    async def forward(self, request, key):
+        """Forward the request to the recursive resolver and return the response.
+        
+        Identical requests which are already in flight share a single upstream query,
+        so the message ID and the case of the question in the response may not be
+        the request's; see wire.splice_request(). No request waits for it longer than
+        UPSTREAM_TIMEOUT; asyncio.TimeoutError is raised, and the next identical request
+        starts over with a new query.
+        """
+        query = self.inflight.get(key)
+        if query is None:
+            query = self.inflight[key] = self.event_loop.create_task(self.pool.query(request))
+            def done(task):
+                if self.inflight.get(key) is task:
+                    del self.inflight[key]
+                # Nobody may be waiting for it anymore.
+                if not task.cancelled():
+                    task.exception()
+                return
+            query.add_done_callback(done)
+        try:
+            # Shielded so that giving up doesn't cancel it for anyone else waiting.
+            response = await asyncio.wait_for(asyncio.shield(query), UPSTREAM_TIMEOUT)
+        except asyncio.TimeoutError:
+            if self.inflight.get(key) is query:
+                del self.inflight[key]
+            raise
+        return response
+
+    def reply(self, request, addr, answer=b'', rcode=dns.rcode.NOERROR):
+        """Send a locally generated response with the answer (if any)."""
+        self.transport.sendto(wire.make_response(request, answer, rcode), addr)
+        return
 
     async def handle_request(self, request, addr):
-        if self.config is None:
-            self.config = Config(load_config(self.exec_dir), self.event_loop)
+        async with self.workers:
+            await self.respond(request, addr)
+        return
+
+    async def respond(self, request, addr):
+        # The config is reloaded if the file has been modified. If it has been broken
+        # (or is briefly missing while being saved) then we soldier on with what we've got.
+        try:
+            yaml_config = load_config(self.exec_dir)
+        except (InvalidConfiguration, yaml.YAMLError, OSError):
+            if self.config is None:
+                raise
+            yaml_config = self.config.config
+        if self.config is None or yaml_config is not self.config.config:
+            self.configure(yaml_config)
         powers = Powers(self.config, request)
 
         # first / last / always / never is sorted out here.
@@ -76,51 +389,51 @@ class SuperUDPListener(asyncio.DatagramProtocol):
             if not powers.ready:
                 await powers.marshall()
             if powers.exec():
-                dns_response = dns.message.make_response(powers.query, recursion_available=True)
-                dns_response.answer.append( dns.rrset.from_text_list( dns_response.question[0].name, TTL, 'IN', 'PTR', [ powers.response ] ))
-                self.transport.sendto(dns_response.to_wire(), addr)
+                self.reply(request, addr, wire.ptr_answer(powers.response, TTL))
                 return
         if not powers() or powers.mode != 'always':
-            reader, writer = await asyncio.open_connection(self.remote_address, self.ssl and 853 or 53, ssl=self.ssl)
-            # NOTE: When using TCP the request and response are prepended with
-            # the length of the request/response.
-            writer.write(len(request).to_bytes(2, byteorder='big')+request)
-            await writer.drain()
-            
-            response_length = int.from_bytes(await reader.read(2), byteorder='big')
-            response = b''
-            while response_length:
-                resp = await reader.read(response_length)
-                if not len(resp):
-                    break
-                response += resp
-                response_length -= len(resp)
-            
-            writer.close()
-            dns_response = dns.message.from_wire(response)
-            if dns_response.rcode() == 0 or not powers() or powers.mode == 'never':
-                self.transport.sendto(response, addr)
+            key = powers.key
+            # PTR responses aren't cached, because they're subject to rewriting.
+            cacheable = powers.qtype != PTR
+            if cacheable:
+                response = self.cache.get(key)
+                if response is not None:
+                    wire.splice_request_into(response, request)
+                    self.transport.sendto(response, addr)
+                    return
+
+            try:
+                response = await self.forward(request, key)
+            except asyncio.TimeoutError:
+                # The client will retry, or give up.
+                return
+            # Belt and suspenders: never pass along (or cache) the answer to some other question.
+            if not wire.same_question(request, response):
+                return
+            # Passing the response through doesn't need anything beyond the header.
+            rcode = wire.rcode(response)
+            if cacheable and rcode == dns.rcode.NOERROR:
+                self.cache.put(key, response, wire.minimum_ttl(response))
+            if rcode == dns.rcode.NOERROR or not powers() or powers.mode == 'never':
+                self.transport.sendto(wire.splice_request(response, request), addr)
                 return
         if powers() and powers.mode == 'last':
             if not powers.ready:
                 await powers.marshall()
             if powers.exec():
-                dns_response = dns.message.make_response(powers.query, recursion_available=True)
-                dns_response.answer.append( dns.rrset.from_text_list( dns_response.question[0].name, TTL, 'IN', 'PTR', [ powers.response ] ))
-                self.transport.sendto(dns_response.to_wire(), addr)
+                self.reply(request, addr, wire.ptr_answer(powers.response, TTL))
                 return
         
         # If we're still hanging around then use the fallback value.
-        if powers() and powers.fqdn.strip('.'):
-            dns_response = dns.message.make_response(powers.query, recursion_available=True)
-            dns_response.answer.append( dns.rrset.from_text_list( dns_response.question[0].name, TTL, 'IN', 'PTR', [ powers.fqdn ] ))
-            self.transport.sendto(dns_response.to_wire(), addr)
+        if powers() and powers.fqdn:
+            answer = self.fallback_answers.get(powers.fqdn)
+            if answer is None:
+                answer = self.fallback_answers[powers.fqdn] = wire.ptr_answer(powers.fqdn, TTL)
+            self.reply(request, addr, answer)
             return
         
         # If we're still here, return NXDOMAIN.
-        dns_response = dns.message.make_response(powers.query, recursion_available=True)
-        dns_response.set_rcode(dns.rcode.NXDOMAIN)
-        self.transport.sendto(dns_response.to_wire(), addr)
+        self.reply(request, addr, rcode=dns.rcode.NXDOMAIN)
 
         return
     
@@ -138,6 +451,12 @@ def main(Listener):
     except:
         print('Usage: superpowers.py {--tls} <udp-listen-address> <remote-server-address>', file=sys.stderr)
         sys.exit(1)
+    # uvloop is faster than the stock event loop, so use it if it's installed.
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     event_loop = asyncio.get_event_loop()
     listener = event_loop.create_datagram_endpoint(Listener, local_addr=(listen_address, 53))
     try:
@@ -157,6 +476,7 @@ def main(Listener):
         service.ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     else:
         service.ssl = None
+    service.pool = TCPConnectionPool(remote_address, service.ssl, event_loop)
 
     try:
         event_loop.run_forever()
@@ -24,6 +24,10 @@ configuration file:
 * params -- parameters required to configure various superpowers
 * subnets -- definitions of powers+subnets
 
+Optionally cache_size can be specified at the top level. This is the maximum
+number of (non-PTR) responses from the recursive resolver which are cached,
+defaulting to 1000. Setting it to 0 disables caching.
+
 Params in the configuration file is a dictionary of dictionaries, where
 each enabled power has its own dictionary of parameters. See the documentation
 for a specific superpower for information on the configuration parameters
@@ -69,21 +73,28 @@ It is possible to leave the powers of a mapping empty to obtain just the
 default explicit rewritings specified with the subnets.
 """
 
+import os
 from os.path import join as path_join
 import asyncio
 
 import yaml
 import ipaddress
-import dns.message
 import importlib
 
 from .nets import Nets
+from .wire import HEADER_LENGTH, parse_question, ptr_address, request_flags
 
 # TODO: Need something in here to enumerate the superpowers within this directory.
 
 CONFIG_FILE = 'superpowers.yaml'
 RECOGNIZED_POWERS = { 'sqlite', 'shodohflo' }
 REQUIRED_NET_SPEC_KEYS = { 'net', 'mode' }
+CACHE_SIZE = 1000
+
+# Configurations which have been loaded, indexed by path. Values are dictionaries
+# with the mtime of the file, the validated config and the compiled Nets object,
+# or the exception raised if the config is invalid.
+_CONFIG_CACHE = {}
 
 PTR = 12
 
@@ -100,8 +111,23 @@ class Superpower(object):
         """Use the superpower to attempt to resolve address.
         
         address is an ipaddress.IPv4Address or IPv6Address. These have some
-        useful polymorphism as they are usable as both an integer and string."""
+        useful polymorphism as they are usable as both an integer and string.
+
+        This is called synchronously by Powers.exec() for every request, so it
+        needs to answer from what's at hand rather than waiting on a remote
+        service. A power backed by a remote service should keep a local copy of
+        the data, refreshed by background tasks (see shodohflo). As a consequence
+        concurrent requests for the same address never duplicate backend I/O.
+        """
         raise NotImplementedError()
+    
+    def close(self):
+        """Stop any background tasks and release resources.
+        
+        Called when the power is replaced because its parameters have changed.
+        Requests already in progress may still call query() afterwards.
+        """
+        pass
 
 class InvalidConfiguration(AttributeError):
     """Raised when the configuration is invalid for structural reasons."""
@@ -116,22 +142,29 @@ class Powers(object):
         >>> from ipaddress import ip_address, ip_network
         >>> config = Config(load_config(), None)
         >>> addr = ip_address('10.0.0.23')
-        >>> scope = config.nets.find(addr)
+        >>> scope = config.nets.find(int(addr))
         >>> scope
         <superpowers.nets.Scope object at 0x7f03ee483ac8>
         >>> str(scope)
-        '25 / last / office-norouting'
+        '25 / last / office-norouting.'
     """
+    __slots__ = ('qtype', 'key', 'address', 'scope', 'powers', 'ready', 'response')
+
     def __init__(self, config, request):
-        self.query = dns.message.from_wire(request)
+        self.qtype, labels, end = parse_question(request)
+        # The question, with the name lowercased because it's case insensitive, and
+        # whatever else about the request changes the response (EDNS, DO, CD).
+        self.key = request[HEADER_LENGTH:end-4].lower() + request[end-4:end] + bytes((request_flags(request),))
         # Request type has to be PTR.
-        if self.query.question[0].rdtype != PTR:
+        if self.qtype != PTR:
+            self.powers = None
+            return
+        address = ptr_address(labels)
+        if address is None:
             self.powers = None
             return
-        self.address = ipaddress.ip_address(
-            '.'.join(( x for x in reversed(self.query.question[0].name.to_text().replace('.in-addr.arpa.','').split('.')) ))
-            )
-        self.scope = config.nets.find(self.address)
+        self.address = address
+        self.scope = config.nets.find(address)
         # If there are no powers being used, then we're "ready", otherwise
         # marshall() should be called before attempting to use powers.
         self.powers = self.scope is not None and self.scope.powers or None
@@ -158,7 +191,8 @@ class Powers(object):
     
     @property
     def fqdn(self):
-        return self.scope.fqdn and self.scope.fqdn.endswith('.') and self.scope.fqdn or self.scope.fqdn+'.'
+        """The fallback FQDN, or an empty string if there isn't one."""
+        return self.scope.fqdn
         
     async def marshall(self):
         """Allow any powers which are still initializing to finish."""
@@ -172,8 +206,9 @@ class Powers(object):
     
     def exec(self):
         """Run the powers and see if they return something useful."""
+        address = ipaddress.IPv4Address(self.address)
         for power in self.powers:
-            self.response = power.query(self.address)
+            self.response = power.query(address)
             if self.response:
                 if not self.response.endswith('.'):
                     self.response += '.'
@@ -205,6 +240,11 @@ class Config(object):
         params = self.config['params']
         return power in params and params[power] or default
     
+    @property
+    def cache_size(self):
+        """The maximum number of responses to cache."""
+        return self.config.get('cache_size', CACHE_SIZE)
+    
     def load_powers(self):
         """Load any powers used by the compiled nets object."""
         for subnet in self.config['subnets']:
@@ -221,39 +261,84 @@ class Config(object):
         
     @property
     def nets(self):
-        """Returns a compiled Nets object."""
+        """Returns a compiled Nets object.
+        
+        If the config came from load_config() then the Nets object is compiled
+        once and shared by every Config which uses it.
+        """
         if self.nets_ is None:
-            self.load_powers()
-            self.nets_ = Nets(self.config['subnets'])
+            cached = None
+            for entry in _CONFIG_CACHE.values():
+                if entry['config'] is self.config:
+                    cached = entry
+                    break
+            if cached is not None and cached['nets'] is not None:
+                self.nets_ = cached['nets']
+            else:
+                self.load_powers()
+                self.nets_ = Nets(self.config['subnets'])
+                if cached is not None:
+                    cached['nets'] = self.nets_
         return self.nets_
     
 def load_config(exec_dir, config=CONFIG_FILE):
-    with open(path_join(exec_dir, config)) as cf:
+    """Load and validate the config.
+    
+    The validated config is cached, and the same object is returned until the
+    file is modified. Likewise if the config is invalid the same exception is
+    raised until the file is modified.
+    """
+    path = path_join(exec_dir, config)
+    mtime = os.stat(path).st_mtime
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached['mtime'] == mtime:
+        if cached['error'] is not None:
+            raise cached['error']
+        return cached['config']
+
+    try:
+        config = read_config(path)
+    except (InvalidConfiguration, yaml.YAMLError, OSError) as e:
+        _CONFIG_CACHE[path] = dict(mtime=mtime, config=None, nets=None, error=e)
+        raise
+    _CONFIG_CACHE[path] = dict(mtime=mtime, config=config, nets=None, error=None)
+    return config
+
+def read_config(path):
+    """Read and validate the config."""
+    with open(path) as cf:
         config = yaml.safe_load(cf)
 
     # Validate the specific parameters which have to occur.
 
+    if type(config) is not dict:
+        raise InvalidConfiguration("The config needs to be a dict.")
     if not 'params' in config:
         raise InvalidConfiguration("No params section.")
     params = config['params']
     if type(params) is not dict:
         raise InvalidConfiguration("Params needs to be a dict.")
-    if 'sqlite' in params and 'db' not in params['sqlite']:
+    if 'sqlite' in params and (type(params['sqlite']) is not dict or 'db' not in params['sqlite']):
         raise InvalidConfiguration("'sqlite' does not contain 'db'.")
-    if 'shodohflo' in params and 'redis_server' not in params['shodohflo']:
+    if 'shodohflo' in params and (type(params['shodohflo']) is not dict or 'redis_server' not in params['shodohflo']):
         raise InvalidConfiguration("'shodohflo' does not contain 'redis_server'.")
 
+    if 'cache_size' in config and (type(config['cache_size']) is not int or config['cache_size'] < 0):
+        raise InvalidConfiguration("cache_size needs to be a non-negative integer.")
+
     if not 'subnets' in config:
         raise InvalidConfiguration("No nets section.")
     subnets = config['subnets']
     if type(subnets) is not list:
-        raise("Subnets needs to be a list of nets.")
+        raise InvalidConfiguration("Subnets needs to be a list of nets.")
     subnet = 0
     
     # Individual subnets...
 
     for net_spec in subnets:
         subnet += 1
+        if type(net_spec) is not dict:
+            raise InvalidConfiguration('Subnet {}: needs to be a dict.'.format(subnet))
         if 'powers' not in net_spec or (net_spec['powers'] is not None and type(net_spec['powers']) is not list):
             raise InvalidConfiguration('Subnet {}: missing "powers".'.format(subnet))
         if net_spec['powers'] is not None and not set(net_spec['powers']) <= RECOGNIZED_POWERS:
@@ -275,9 +360,13 @@ def load_config(exec_dir, config=CONFIG_FILE):
                 if not set(net.keys()) >= REQUIRED_NET_SPEC_KEYS:
                     raise InvalidConfiguration("Subnet {}: net spec doesn't contain 'net' and 'mode'".format(subnet))
                 try:
-                    net['net'] = ipaddress.ip_network(net['net'])
+                    network = ipaddress.ip_network(net['net'])
                 except ValueError:
                     raise InvalidConfiguration("Subnet {}: net spec contains an invalid network '{}'".format(subnet, net['net']))
+                # Only the numbers are kept, not the network object.
+                net['net_int'] = int(network.network_address)
+                net['prefixlen'] = network.prefixlen
+                net['version'] = network.version
             else:
                 raise InvalidConfiguration("Subnet {} contains an invalid net spec: '{}'".format(subnet, net))
             
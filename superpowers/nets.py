@@ -18,88 +18,112 @@
 
 import ipaddress
 
+# Results of Nets.find() are cached for this many addresses.
+FIND_CACHE_SIZE = 4096
+
+# Marks a cache miss, since None is a legitimate result.
+_MISS = object()
+
 class Scope(object):
+    __slots__ = ('scope', 'mode', 'fqdn', 'powers')
+
     def __init__(self, powers, scope, mode, fqdn=""):
         self.scope = scope
         self.mode = mode
-        self.fqdn = fqdn
+        # Normalized to be fully qualified (or empty).
+        fqdn = (fqdn or '').rstrip('.')
+        self.fqdn = fqdn and fqdn + '.' or ''
         self.powers = powers
         return
     
     def __str__(self):
         return '{} / {} / {}'.format(self.scope, self.mode, self.fqdn or '--')
 
-class Node(object):
-    """Encapsulates a single address at all scopes."""
-    LT = 0
-    GT = 1
-    
-    def __init__(self, address, *scopes):
-        """Each node is comprised of an address at one or more scopes."""
-        self.address = address
-        self.scopes = sorted(scopes, key=lambda x:x.scope, reverse = True)
-        return
-    
-    def __str__(self):
-        result = [ str(scope) for scope in self.scopes ]
-        return '\n'.join(result)
-    
-    @classmethod
-    def new(cls, powers, subnet):
-        address = int(subnet['net'].network_address)
-        mask = subnet['net'].prefixlen
-        return Node(address, Scope(powers, mask, subnet['mode'], 'fqdn' in subnet and subnet['fqdn'] or ''))
+class Branch(object):
+    """A node in a binary trie of network prefixes.
     
-    def add_scope(self, scope):
-        """Something with the same address and scope replaces the previous value."""
-        for i in range(len(self.scopes)):
-            if self.scopes[i].scope == scope.scope:
-                self.scopes[i] = scope
-                return
-        self.scopes.append(scope)
-        self.scopes = sorted(self.scopes, key=lambda x:x.scope, reverse=True)
+    The path from the root of the trie to a Branch spells out the leading bits
+    of a network address, and the scope (if any) is for that network.
+    """
+    __slots__ = ('children', 'scope')
+
+    def __init__(self):
+        # Indexed by the value of the next bit.
+        self.children = [None, None]
+        self.scope = None
         return
         
-    def get_scope(self, bits):
-        for scope in self.scopes:
-            if scope.scope <= bits:
-                return scope
-        return None
-        
 class Nets(object):
     """Encapsulates an entire address space with rewriting rules.
     
     Allows both subnets, and individual addresses or /32.
     """
     def __init__(self, subnets):
-        nets = self.nets = dict()
+        self.trie = Branch()
+        # Results of find(), indexed by the address as an int. When the config is
+        # reloaded a new Nets object is created, so this never needs to be invalidated.
+        self.cache = dict()
         for net_spec in subnets:
             powers = net_spec['powers']
             for subnet in net_spec['nets']:
-                node = Node.new(powers, subnet)
-                if node.address in nets:
-                    nets[node.address].add_scope(node.scopes[0])
-                else:
-                    nets[node.address] = node
+                # Only IPv4 PTR queries are rewritten.
+                if subnet['version'] != 4:
+                    continue
+                self.insert(subnet['net_int'],
+                            Scope(powers, subnet['prefixlen'], subnet['mode'], 'fqdn' in subnet and subnet['fqdn'] or '')
+                           )
+        return
+    
+    def insert(self, address, scope):
+        """Something with the same address and scope replaces the previous value."""
+        branch = self.trie
+        for shift in range(31, 31 - scope.scope, -1):
+            bit = (address >> shift) & 1
+            if branch.children[bit] is None:
+                branch.children[bit] = Branch()
+            branch = branch.children[bit]
+        branch.scope = scope
         return
     
     def __str__(self):
+        nets = dict()
+        branches = [ (self.trie, 0, 0) ]
+        while branches:
+            branch, address, depth = branches.pop()
+            if branch.scope is not None:
+                nets[address] = nets.get(address, []) + [ branch.scope ]
+            for bit in (0, 1):
+                if branch.children[bit] is not None:
+                    branches.append((branch.children[bit], address | bit << (31 - depth), depth + 1))
         result = []
-        for k in self.nets.keys():
-            result.append('Subnet {}:\n{}'.format(ipaddress.ip_address(k), self.nets[k]))        
+        for k in sorted(nets.keys()):
+            scopes = sorted(nets[k], key=lambda x:x.scope, reverse=True)
+            result.append('Subnet {}:\n{}'.format(ipaddress.ip_address(k), '\n'.join( str(scope) for scope in scopes )))
         return '\n'.join(result)
         
     def find(self, address):
-        """Return the effective scope."""
-        all_bits = 2**32 - 1
-        address = int(address)
-        for i in range(33):
-            effective_address = address & (all_bits ^ (2**i - 1))
-            if effective_address not in self.nets:
-                continue
-            node = self.nets[effective_address]
-            scope = node.get_scope(32-i)
-            if scope:
-                return scope
-        return None
+        """Return the effective scope.
+        
+        This is the innermost (longest prefix) scope containing the address. The
+        trie is walked from the most significant bit, stopping as soon as there is
+        nothing more specific.
+        
+        The address is an int. Convert ipaddress.IPv4Address objects with int().
+        """
+        scope = self.cache.get(address, _MISS)
+        if scope is not _MISS:
+            return scope
+        branch = self.trie
+        scope = branch.scope
+        for shift in range(31, -1, -1):
+            branch = branch.children[(address >> shift) & 1]
+            if branch is None:
+                break
+            if branch.scope is not None:
+                scope = branch.scope
+        if len(self.cache) >= FIND_CACHE_SIZE:
+            # Oldest first.
+            del self.cache[next(iter(self.cache))]
+        self.cache[address] = scope
+        return scope
 
@@ -106,6 +106,11 @@ class ListArtifact(ClientArtifact):
     def extract_value_data(self,v):
         self.onames = [ oname for oname in v.split(';') if oname ]
 
+    @property
+    def norm_onames(self):
+        """onames, lowercased with no trailing dot."""
+        return [ oname.lower().rstrip('.') for oname in self.onames ]
+
     def update_origins(self, origin_type, origin_list):
         """Update origin_list.
         
@@ -152,6 +157,11 @@ class DNSArtifact(ListArtifact):
         self.remote_address = ipaddress.ip_address(k[self.REMOTE_ADDR])
         return
 
+    @property
+    def norm_target(self):
+        """The remote address, which is already normalized."""
+        return str(self.remote_address)
+
     # update_origins() declared in ListArtifact.
     
     # update_mappings() and update_fqdn_mappings() declared in ListArtifact.
@@ -212,6 +222,11 @@ class CNAMEArtifact(ListArtifact):
         self.rname = k[self.RNAME]
         return
     
+    @property
+    def norm_target(self):
+        """rname, lowercased with no trailing dot."""
+        return self.rname.lower().rstrip('.')
+    
     @property
     def name(self):
         return self.rname
@@ -266,24 +281,34 @@ ARTIFACT_MAPPER = dict(
         cname   = CNAMEArtifact
     )
 
-async def Artifact(r_client, k, types=None):
-    """Factory function which returns instances of ClientArtifact for the passed key.
+def artifact_class(k, types=None):
+    """Returns the subclass of ClientArtifact for the passed key.
     
     types specifies the key types we're interested in. If not supplied then this
-    returns all the things.
+    returns all the things. If the key isn't of interest None is returned.
     """
-
     artifact_type = k.split(b';')[-1].decode()
     if artifact_type not in ARTIFACT_MAPPER:
         return None
     if types is not None and artifact_type not in types:
         return None
+    return ARTIFACT_MAPPER[artifact_type]
+
+async def Artifact(r_client, k, types=None):
+    """Factory function which returns instances of ClientArtifact for the passed key.
+    
+    types specifies the key types we're interested in. If not supplied then this
+    returns all the things.
+    """
+    constructor = artifact_class(k, types)
+    if constructor is None:
+        return None
     
     v = await r_client.get(k)
     if not v:
         return None
     
-    return ARTIFACT_MAPPER[artifact_type](k.decode(), v.decode())
+    return constructor(k.decode(), v.decode())
 
 DNS_TYPES = { 'dns', 'cname' }
 
@@ -292,11 +317,32 @@ async def get_dns_data(r_client, client):
     
     This is A/AAAA and CNAME records.
     """
+    return await get_batch_dns_data(r_client, [client])
+
+async def get_batch_dns_data(r_client, clients):
+    """Get all DNS data associations for a batch of clients.
+    
+    This is A/AAAA and CNAME records. The commands are pipelined, so this costs
+    two round trips regardless of the number of clients: one for the keys and one
+    for the values.
+    """
+    pipe = r_client.pipeline()
+    for client in clients:
+        pipe.keys('{};*'.format(str(client)))
+    keys = []
+    for client_keys in await pipe.execute():
+        for k in client_keys:
+            constructor = artifact_class(k, DNS_TYPES)
+            if constructor is None:
+                continue
+            keys.append((k, constructor))
+    if not keys:
+        return []
+    
     all_artifacts = []
-    for k in await r_client.keys('{};*'.format(str(client))):
-        artifact = await Artifact(r_client, k, DNS_TYPES)
-        if artifact is None:
+    for (k, constructor), v in zip(keys, await r_client.mget(*( k for k, constructor in keys ))):
+        if not v:
             continue
-        all_artifacts.append(artifact)
+        all_artifacts.append(constructor(k.decode(), v.decode()))
     return all_artifacts
 
@@ -33,37 +33,59 @@ The following configuraiton parameters can be specified:
                 of associations exceeds this value. Defaults to 5000
 """
 
+import sys
 import asyncio
 import aioredis
 
 from time import time
 from random import random
+from collections import OrderedDict
+from itertools import takewhile
 
 from . import Superpower as SuperpowerBase
-from .redis_data import get_all_clients, get_dns_data, DNSArtifact, CNAMEArtifact
+from .redis_data import get_all_clients, get_batch_dns_data, DNSArtifact, CNAMEArtifact
 
 TTL = 7200
 MAX_ASSOCS = 5000
 
 # These are the delays between started an entirely new refresh cycle, and refreshing
-# individual clients, respectively.
+# individual batches of clients, respectively.
 CYCLE_DELAY = 10
 CLIENT_DELAY = 1
 
-class Clients(object):
-    """All client IP addresses."""
-    def __init__(self):
-        self.clients = []
-        return
-    
+# The number of clients refreshed with each (pipelined) batch of Redis requests.
+CLIENT_BATCH = 50
+
+# The maximum number of associations purged by a single add(). Whatever is left
+# over is purged once per refresh cycle.
+PURGE_BUDGET = 64
+
+# Size of the Redis connection pool. Redis is only read by the refresh task, one
+# (pipelined) batch at a time, so there's no point in having more than a spare.
+REDIS_POOL_MIN = 1
+REDIS_POOL_MAX = 2
+
+# Results of query() are cached for this many addresses, until the associations
+# change.
+QUERY_CACHE_SIZE = 4096
+
+def reversed_labels(fqdn):
+    """The labels of fqdn, TLD first."""
+    return tuple(reversed(fqdn.split('.')))
+
 class Association(object):
-    """A single association."""
+    """A single association.
+    
+    The reversed labels of the target and fqdns are kept for match_len().
+    """
+    __slots__ = ('target', 'reversed_labels', 'ttl', 'fqdns', 'fqdn_labels', 'expires')
+
     def __init__(self, target, fqdns, ttl):
         self.target = target
-        self.fqdns = fqdns
+        self.reversed_labels = reversed_labels(target)
         self.ttl = ttl
-        self.expires = self.expiry()
-        self.orig_expires = self.expires
+        self.fqdns = None
+        self.update(fqdns)
         return
     
     def expiry(self):
@@ -71,135 +93,131 @@ class Association(object):
         return time() + self.ttl * (0.95 + 0.1 * random())
     
     def update(self, fqdns):
-        self.fqdns = fqdns
+        """Refresh the expiry, and the fqdns. Returns True if the fqdns changed."""
         self.expires = self.expiry()
-        return
-    
-    def moving(self):
-        """A signal that expiry lists are being rotated."""
-        self.orig_expires = self.expires
-        return
-    
-    @property
-    def updated(self):
-        """True if expires is not equal to orig_expires."""
-        return self.expires != self.orig_expires
+        if fqdns == self.fqdns:
+            return False
+        self.fqdns = fqdns
+        self.fqdn_labels = { fqdn:reversed_labels(fqdn) for fqdn in fqdns }
+        return True
 
 class Associations(object):
     """All address/fqdn -> fqdn associations."""
     def __init__(self):
-        # An Association is referenced in this index as well as in one of the
-        # following expiry lists.
         self.index = {}
-        # These lists are sorted in increasing order by Association.orig_expires.
-        # When we need to eject things from cache, we process the entries in
-        # self.expiry in order. It can happen that something is refreshed, in which
-        # case Association.expires > Association.orig_expires. When processing an
-        # entry, we use Association.expires. If Association.expires > now,
-        # Association.orig_expires is set to Association.expires and the entry is
-        # appended to self.new_expiry instead of being deleted. When self.expiry
-        # is exhausted, self.new_expiry is sorted by Association.orig_expires and
-        # replaces self.expiry.
-        self.expiry = []
-        self.new_expiry = []
+        # The expiry of each association, keyed by target, in the order in which
+        # they were added or last updated, oldest first. Since the expiry is
+        # recomputed whenever that happens this is (give or take the jitter) the
+        # order in which they expire, and refreshing an entry is just a matter of
+        # moving it to the end. Purging doesn't need to look at the Associations.
+        self.order = OrderedDict()
+        # When the oldest association expires, as of the last purge. Associations
+        # behind it expire later (give or take the jitter), so there's nothing to
+        # purge before then unless there are too many of them.
+        self.next_expiry = 0
+        # Incremented whenever an association is added, removed or changes its
+        # fqdns; anything derived from the associations is stale once this changes.
+        self.generation = 0
         return
     
     def remove_one(self):
-        """Called to move/remove one item.
-        
-        Returns True if the item was purged, False if it was moved to self.new_expiry.
-        """
-        item = self.expiry.pop(0)
-        if item.updated:
-            self.new_expiry.append(item)
-            return
-        del self.index[item.target]
-        return
-        
-    def rotate_lists(self):
-        """Promotes new_expiry to expiry."""
-        for item in self.new_expiry:
-            item.moving()
-        self.expiry = sorted(self.new_expiry, key=lambda x:x.orig_expires)
-        self.new_expiry = []
+        """Remove the oldest item."""
+        target, expires = self.order.popitem(last=False)
+        del self.index[target]
+        self.generation += 1
         return
         
-    def purge(self):
+    def purge(self, budget=None):
         """Purge stuff from the cache which is expired/oldest.
         
         Stuff is purged which is older than TTL or if the total number of entries
-        is in excess of MAX_ASSOCS.
+        is in excess of MAX_ASSOCS. If budget is specified, at most that many
+        entries are purged.
         """
-        if not self.index:
-            return
         now = time()
-        
-        while self.expiry[0].orig_expires <= now or len(self.index) > MAX_ASSOCS:
+        if now < self.next_expiry and len(self.index) <= MAX_ASSOCS:
+            return
+        while self.order and budget != 0:
+            expires = next(iter(self.order.values()))
+            if expires > now and len(self.index) <= MAX_ASSOCS:
+                self.next_expiry = expires
+                break
             self.remove_one()
-            if not self.expiry:
-                if not self.index:
-                    return
-                self.rotate_lists()
+            if budget is not None:
+                budget -= 1
         return
     
     def add(self, artifact, ttl):
         """Add an A / AAAA / CNAME record or update its TTL."""
-        self.purge()
+        self.purge(PURGE_BUDGET)
         
-        target = ( isinstance(artifact, DNSArtifact)
-               and str(artifact.remote_address) or artifact.name
-                 ).lower().rstrip('.')
-        fqdns = [ name.lower().rstrip('.') for name in artifact.onames ]
+        # The same names recur across associations and refreshes, so they're
+        # interned to share a single copy (and make comparisons cheap).
+        target = sys.intern(artifact.norm_target)
+        fqdns = [ sys.intern(fqdn) for fqdn in artifact.norm_onames ]
 
-        if target in self.index:
-            self.index[target].update(fqdns)
+        association = self.index.get(target)
+        if association is not None:
+            if association.update(fqdns):
+                self.generation += 1
+            self.order[target] = association.expires
+            self.order.move_to_end(target)
             return
         
         association = Association(target, fqdns, ttl)
         self.index[target] = association
-        (self.new_expiry or self.expiry).append(association)
+        self.order[target] = association.expires
+        self.generation += 1
         
         return
     
     def get(self, k):
-        return self.index.get(str(k), None)
+        return self.index.get(k)
 
-class DictOfSets(dict):
-    def add(self, k, v):
-        if k not in self:
-            self[k] = set()
-        self[k].add(v)
-        return
-    
 class Superpower(SuperpowerBase):
     """Check ShoDoHFlo's database."""
 
     def __init__(self, *args):
         SuperpowerBase.__init__(self, *args)
         self.associations = Associations()
+        self.query_cache = dict()
+        self.query_generation = self.associations.generation
         # Create a connection to the Redis database and cache it.
         self.ttl = self.config.get('ttl', TTL)
         self.max_assocs = self.config.get('max_assocs', MAX_ASSOCS)
         self.redis_host = self.config['redis_server']
+        self.redis = None
+        self.init_task = self.refresh_task = None
         # Initialize the cache. We allow for event_loop to be None as a flag
         # that we're running (query) tests.
         if self.event_loop is not None:
-            self.tasks.append(self.event_loop.create_task(self.init_cache()))
+            self.init_task = self.event_loop.create_task(self.init_cache())
+            self.tasks.append(self.init_task)
+        return
+    
+    def close(self):
+        for task in (self.init_task, self.refresh_task):
+            if task is not None:
+                task.cancel()
+        if self.redis is not None:
+            self.redis.close()
         return
 
     async def init_cache(self):
-        self.redis = await aioredis.create_redis_pool('redis://'+self.redis_host)
+        # No encoding: redis_data decodes only what it uses.
+        self.redis = await aioredis.create_redis_pool('redis://'+self.redis_host, encoding=None,
+                                                      minsize=REDIS_POOL_MIN, maxsize=REDIS_POOL_MAX)
         await self.refresh_cache(no_wait=True)
-        self.event_loop.create_task(self.periodic_refresh())
+        self.refresh_task = self.event_loop.create_task(self.periodic_refresh())
         return
     
     async def refresh_cache(self, no_wait=False):
         clients = await get_all_clients(self.redis)
-        for client in clients:
+        for i in range(0, len(clients), CLIENT_BATCH):
             if not no_wait:
                 await asyncio.sleep(CLIENT_DELAY)
             # Only A / AAAA / CNAME derived data is returned.
-            for rec in await get_dns_data(self.redis, client):
+            for rec in await get_batch_dns_data(self.redis, clients[i:i+CLIENT_BATCH]):
                 self.associations.add(rec, self.ttl)
         return
 
@@ -208,48 +226,83 @@ class Superpower(SuperpowerBase):
         
         This task never exits.
         """
-        started_cycle = time()
+        # The loop's clock is monotonic, so cycles aren't thrown off by clock changes.
+        clock = self.event_loop.time
+        started_cycle = clock()
         while True:
-            now = time()
-            if (now - started_cycle) < CYCLE_DELAY:
-                await asyncio.sleep(CYCLE_DELAY - (now - started_cycle) + 1)
-            started_cycle = time()
+            await asyncio.sleep(max(0, started_cycle + CYCLE_DELAY - clock()))
+            started_cycle = clock()
             await self.refresh_cache()
+            self.associations.purge()
         # Never exits.
     
     def follow_chains(self, root, chains):
-        associations = self.associations.get(root[-1])
-        if associations is None:
-            if len(root) > 1:
-                chains.append(root.copy())
-            return
-        for association in associations.fqdns:
-            if association in root and root not in chains:
-                chains.append(root.copy())
-                return
-            self.follow_chains(root + [association], chains)
+        """Appends all of the chains of associations starting from root to chains.
+        
+        A chain ends with a name which has no associations, or where it would
+        loop back on itself.
+        """
+        # Chains in progress, with the set of names in each one for loop detection.
+        stack = [ (root, set(root)) ]
+        # Chains which have been appended, as tuples, to avoid duplicates.
+        chain_set = set()
+        while stack:
+            root, seen = stack.pop()
+            associations = self.associations.index.get(root[-1])
+            if associations is None:
+                chain = tuple(root)
+                if len(chain) > 1 and chain not in chain_set:
+                    chains.append(root)
+                    chain_set.add(chain)
+                continue
+            branches = []
+            for association in associations.fqdns:
+                if association in seen:
+                    chain = tuple(root)
+                    if chain not in chain_set:
+                        chains.append(root)
+                        chain_set.add(chain)
+                    break
+                branches.append((root + [association], seen | {association}))
+            # Reversed so that they're followed in order.
+            stack.extend(reversed(branches))
         return
     
-    @staticmethod
-    def match_len(chain):
+    def match_len(self, chain):
         """What is the common TLD?"""
         previous,current = chain[-2:]
-        previous = [ x for x in reversed(str(previous).split('.')) ]
-        current = [ x for x in reversed(str(current).split('.')) ]
+        # The last link in the chain came from the association for previous, unless
+        # it has been updated (or purged) since.
+        association = self.associations.index.get(previous)
+        if association is not None and current in association.fqdn_labels:
+            previous = association.reversed_labels
+            current = association.fqdn_labels[current]
+        else:
+            previous = reversed_labels(previous)
+            current = reversed_labels(current)
 
-        max_length = min(( len(x) for x in (previous,current) ))
-        i = 0
-        while i < max_length:
-            if previous[i] != current[i]:
-                return i
-            i += 1
-        return i
+        return sum(1 for x in takewhile(lambda pair: pair[0] == pair[1], zip(previous, current)))
             
     def query(self, address):
+        """Cached lookups, see find_fqdn()."""
+        if self.query_generation != self.associations.generation:
+            self.query_cache.clear()
+            self.query_generation = self.associations.generation
+        fqdn = self.query_cache.get(address)
+        if fqdn is not None:
+            return fqdn
+        fqdn = self.find_fqdn(address)
+        if len(self.query_cache) >= QUERY_CACHE_SIZE:
+            # Evict the oldest entry.
+            del self.query_cache[next(iter(self.query_cache))]
+        self.query_cache[address] = fqdn
+        return fqdn
+            
+    def find_fqdn(self, address):
         # Get all possible chains.
         chains = []
 
-        self.follow_chains([address], chains)
+        self.follow_chains([str(address)], chains)
         # None?
         if not chains:
             return ''
@@ -258,35 +311,7 @@ class Superpower(SuperpowerBase):
         if len(chains) == 1:
             return chains[0][-1]
         
-        # Look for the longest chain.
-        lengths = DictOfSets()
-        for i,chain in enumerate(chains):
-            lengths.add(len(chain), i)
-        max_length = max(lengths.keys())
-        
-        if len(lengths[max_length]) == 1:
-            return chains[lengths[max_length].pop()][-1]
-        
-        # Look for the one with the least matching labels / most different domain.
-        # This only works if there is at least one CNAME in the chain.
-        candidates = list(lengths[max_length])
-        
-        if max_length >= 2:
-            lengths = DictOfSets()
-            for i,candidate in enumerate(candidates):
-                lengths.add(self.match_len(chains[candidate]), i)
-            min_match = min(lengths.keys())
-            if len(lengths[min_match]) == 1:
-                return chains[candidates[lengths[min_match].pop()]][-1]
-        
-        # Look for the least number of labels.
-        candidates = list(lengths[min_match])
-
-        lengths = DictOfSets()
-        for i,candidate in enumerate(candidates):
-            lengths.add(len(chains[candidate][-1]), i)
-        min_length = min(lengths.keys())
-
-        # If there's more than one it really doesn't matter which one
-        # we return.
-        return chains[candidates[lengths[min_length].pop()]][-1]
+        # Look for the longest chain, then the one with the least matching labels /
+        # most different domain, then the least number of labels. If there's more
+        # than one it really doesn't matter which one we return.
+        return min(chains, key=lambda chain: (-len(chain), self.match_len(chain), len(chain[-1])))[-1]
@@ -22,6 +22,10 @@ The database consists of a single table named Address with two fields:
 
 Both fields are strings.
 
+The table is read into memory, and read again when other processes change the
+database. Changes are picked up within CHECK_INTERVAL seconds; reload() can be
+called to see them immediately.
+
 Configuration Parameters
 ------------------------
 
@@ -31,6 +35,7 @@ The following configuration parameters can be specified:
 """
 
 import os.path
+import asyncio
 from sqlite3 import dbapi2 as sqlite3
 
 from . import Superpower as SuperpowerBase
@@ -42,6 +47,9 @@ CREATE TABLE Address (
 );
 """
 
+# How often (seconds) to check whether the database has been changed.
+CHECK_INTERVAL = 1
+
 class Superpower(SuperpowerBase):
     """Check a sqlite database."""
 
@@ -54,10 +62,40 @@ class Superpower(SuperpowerBase):
             self.db.cursor().executescript(SCHEMA)
             self.db.commit()
         self.db.row_factory = sqlite3.Row
+        self.reload()
+        # As with shodohflo, event_loop is None when we're running (query) tests.
+        self.reload_task = None
+        if self.event_loop is not None:
+            self.reload_task = self.event_loop.create_task(self.periodic_reload())
+        return
+    
+    def close(self):
+        if self.reload_task is not None:
+            self.reload_task.cancel()
+        self.db.close()
         return
     
+    def get_data_version(self):
+        """This changes when some other connection commits changes to the database."""
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+    
+    def reload(self):
+        """Read the entire table."""
+        self.data_version = self.get_data_version()
+        self.addresses = { rec[0]:rec[1] or '' for rec in self.db.execute("SELECT address, fqdn FROM Address") }
+        return
+    
+    async def periodic_reload(self):
+        """Reload the table whenever the database changes.
+        
+        This task never exits.
+        """
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            if self.get_data_version() != self.data_version:
+                self.reload()
+        # Never exits.
+
     def query(self, address):
-        cur = self.db.execute("SELECT fqdn FROM Address where address = ?", (str(address),))
-        rec = cur.fetchone()
-        return rec is not None and rec[0] or ''
+        return self.addresses.get(str(address), '')
         
\ No newline at end of file
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# Copyright (c) 2021 by Fred Morris Tacoma WA
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Byte level handling of DNS messages.
+
+dnspython does a thorough job of parsing and rendering messages, which is a lot
+more work than is needed for the few things we do with every request.
+"""
+
+import struct
+
+import dns.name
+
+HEADER_LENGTH = 12
+PTR = 12
+OPT = 41
+IN = 1
+
+# Header flags.
+QR = 0x8000
+RA = 0x0080
+CD = 0x0010
+# Opcode, RD and CD are copied from the request to the response.
+COPIED_FLAGS = 0x7910
+
+# Section counts: question, answer, authority, additional.
+COUNTS = struct.Struct('!HHHH')
+# The header following the message ID: flags and section counts.
+FLAGS_COUNTS = struct.Struct('!HHHHH')
+# Resource record fields following the name: type, class, ttl, rdlength.
+RR_FIELDS = struct.Struct('!HHIH')
+
+# DNSSEC OK, in the TTL field of the OPT pseudo-record.
+DO = 0x8000
+
+# The OPT pseudo-record added to locally generated responses when the request has
+# one: root name, type, UDP payload size, extended rcode / version / flags (all 0)
+# and no options.
+OPT_RECORD = b'\x00' + RR_FIELDS.pack(OPT, 1232, 0, 0)
+
+# Bits returned by request_flags().
+HAS_EDNS = 0x01
+WANTS_DNSSEC = 0x02
+CHECKING_DISABLED = 0x04
+
+def rcode(message):
+    """The (non-extended) rcode from the header."""
+    return message[3] & 0x0f
+
+def skip_name(message, offset):
+    """Returns the offset following the (possibly compressed) name at offset."""
+    while True:
+        length = message[offset]
+        if length >= 0xc0:
+            # Compression pointer.
+            return offset + 2
+        offset += length + 1
+        if not length:
+            return offset
+
+def parse_question(message):
+    """Returns the type, labels and ending offset of the (first) question.
+
+    The labels are bytes and end with the (empty) root label, as with
+    dns.name.Name.labels. There's no need to deal with compression pointers,
+    since the question's name is always the first one in the message.
+    """
+    labels = []
+    offset = HEADER_LENGTH
+    while True:
+        length = message[offset]
+        if length > 63:
+            raise ValueError('Invalid label length in question.')
+        offset += 1
+        labels.append(message[offset:offset+length])
+        offset += length
+        if not length:
+            break
+    qtype = message[offset] << 8 | message[offset+1]
+    return qtype, labels, offset + 4
+
+def question_end(message):
+    """Returns the offset following the (first) question."""
+    return skip_name(message, HEADER_LENGTH) + 4
+
+def same_question(request, response):
+    """Is the response for the same question as the request?
+
+    The comparison is case insensitive.
+    """
+    end = question_end(request)
+    return response[HEADER_LENGTH:end].lower() == request[HEADER_LENGTH:end].lower()
+
+def splice_request_into(response, request):
+    """Copies the message ID and question from the request into the response.
+
+    The response is a bytearray for the same question (see same_question()), which
+    may differ in case; some resolvers randomize it (0x20) and check it's preserved.
+    """
+    end = question_end(request)
+    response[0:2] = request[0:2]
+    response[HEADER_LENGTH:end] = request[HEADER_LENGTH:end]
+    return
+
+def splice_request(response, request):
+    """Returns the response with the message ID and question from the request.
+
+    Like splice_request_into(), but a copy is only made if they differ.
+    """
+    end = question_end(request)
+    if response[:2] == request[:2] and response[HEADER_LENGTH:end] == request[HEADER_LENGTH:end]:
+        return response
+    response = bytearray(response)
+    splice_request_into(response, request)
+    return response
+
+def encode_name(fqdn):
+    """Returns the (uncompressed) wire format of the name.
+
+    Plain ASCII names are encoded directly. Anything out of the ordinary (escapes,
+    IDNs, empty or overlong labels) is left to dnspython.
+    """
+    try:
+        name = fqdn.encode('ascii')
+    except UnicodeEncodeError:
+        return dns.name.from_text(fqdn).to_wire()
+    labels = name.rstrip(b'.').split(b'.')
+    if b'\\' in name or len(name) > 253 or not all( 0 < len(label) < 64 for label in labels ):
+        return dns.name.from_text(fqdn).to_wire()
+    return b''.join( bytes((len(label),)) + label for label in labels ) + b'\x00'
+
+def ptr_answer(fqdn, ttl):
+    """Returns a PTR resource record for the name in the question.
+
+    The owner name is a compression pointer to the question, which always
+    immediately follows the header. This means it doesn't depend on the request
+    and can be built once and reused.
+    """
+    name = encode_name(fqdn)
+    return b'\xc0\x0c' + RR_FIELDS.pack(PTR, IN, ttl, len(name)) + name
+
+def make_response(request, answer=b'', rcode=0):
+    """Returns a response to the request with the answer (if any).
+
+    The question is copied verbatim from the request, and if the request has an
+    OPT record then so does the response.
+    """
+    end = question_end(request)
+    opt = request_flags(request) & HAS_EDNS and OPT_RECORD or b''
+    flags = QR | RA | ((request[2] << 8 | request[3]) & COPIED_FLAGS) | rcode
+    return b''.join((
+            request[0:2],
+            FLAGS_COUNTS.pack(flags, 1, answer and 1 or 0, 0, opt and 1 or 0),
+            request[HEADER_LENGTH:end],
+            answer,
+            opt
+        ))
+
+def records(message):
+    """Generates (offset, type, ttl) for each resource record in the message.
+
+    offset is where the type, class, ttl and rdlength fields start. IndexError or
+    struct.error is raised if the message is malformed.
+    """
+    qdcount, ancount, nscount, arcount = COUNTS.unpack_from(message, 4)
+    offset = HEADER_LENGTH
+    for i in range(qdcount):
+        offset = skip_name(message, offset) + 4
+    for i in range(ancount + nscount + arcount):
+        offset = skip_name(message, offset)
+        rdtype, rdclass, ttl, rdlength = RR_FIELDS.unpack_from(message, offset)
+        yield offset, rdtype, ttl
+        offset += RR_FIELDS.size + rdlength
+    return
+
+def minimum_ttl(message):
+    """Returns the shortest TTL of the resource records in the message.
+
+    The OPT pseudo-record doesn't count. If there are no resource records, or the
+    message is malformed, 0 is returned.
+    """
+    try:
+        ttl = min(( rr_ttl for offset, rdtype, rr_ttl in records(message) if rdtype != OPT ), default=0)
+    except (IndexError, struct.error):
+        return 0
+    return ttl
+
+def age_ttls(message, seconds):
+    """Returns a copy of the message with seconds subtracted from the TTLs.
+
+    TTLs don't go below 0, and the OPT pseudo-record isn't touched.
+    """
+    message = bytearray(message)
+    for offset, rdtype, ttl in records(message):
+        if rdtype != OPT:
+            struct.pack_into('!I', message, offset + 4, max(0, ttl - seconds))
+    return message
+
+def request_flags(message):
+    """Returns the things about a request, beyond the question, which change the response.
+
+    This is a combination of HAS_EDNS, WANTS_DNSSEC (the DO bit) and
+    CHECKING_DISABLED (the CD bit).
+    """
+    flags = message[3] & CD and CHECKING_DISABLED or 0
+    try:
+        for offset, rdtype, ttl in records(message):
+            if rdtype == OPT:
+                flags |= HAS_EDNS
+                if ttl & DO:
+                    flags |= WANTS_DNSSEC
+                break
+    except (IndexError, struct.error):
+        pass
+    return flags
+
+def ptr_address(labels):
+    """Returns the IPv4 address for an in-addr.arpa name as an int.
+
+    labels is a sequence of (bytes) labels ending with the root label, as in
+    dns.name.Name.labels. None is returned if it's not a complete in-addr.arpa
+    name for an address.
+    """
+    if len(labels) != 7 or labels[6] or labels[5].lower() != b'arpa' or labels[4].lower() != b'in-addr':
+        return None
+    address = 0
+    for octet in (labels[3], labels[2], labels[1], labels[0]):
+        if len(octet) > 3 or not octet.isdigit():
+            return None
+        octet = int(octet)
+        if octet > 255:
+            return None
+        address = (address << 8) | octet
+    return address
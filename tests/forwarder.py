@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+# Copyright (c) 2021 by Fred Morris Tacoma WA
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the forwarder (superpowers.py), against a fake recursive resolver."""
+
+import sys
+import os
+import asyncio
+import unittest
+import tempfile
+import importlib.util
+
+import dns.message
+import dns.rrset
+
+if '..' not in sys.path:
+    sys.path.insert(0,'..')
+
+# superpowers.py is a script, and has the same name as the package.
+spec = importlib.util.spec_from_file_location('forwarder', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'superpowers.py'))
+forwarder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(forwarder)
+
+CONFIG = """
+params: {}
+subnets: []
+"""
+
+class Upstream(object):
+    """A fake recursive resolver.
+    
+    Every A query is answered with address (default 10.0.0.1) and a TTL of 300,
+    after delay (default none). Behavior is set per name:
+    
+    * addresses -- the address to answer with
+    * delays    -- how long to wait before answering
+    * resets    -- the connection is closed instead of answering, once
+    """
+    def __init__(self):
+        self.connections = 0
+        self.queries = []
+        self.addresses = {}
+        self.delays = {}
+        self.resets = set()
+        self.writers = []
+        return
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return
+    
+    async def close(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        # Let the connections wind down.
+        await asyncio.sleep(0.01)
+        return
+    
+    async def serve(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                request = dns.message.from_wire(await reader.readexactly(length))
+                name = request.question[0].name.to_text().lower()
+                self.queries.append(name)
+                if name in self.resets:
+                    self.resets.remove(name)
+                    writer.close()
+                    return
+                asyncio.get_running_loop().create_task(self.answer(writer, request, name))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        return
+    
+    async def answer(self, writer, request, name):
+        await asyncio.sleep(self.delays.get(name, 0))
+        response = dns.message.make_response(request)
+        response.answer.append(
+            dns.rrset.from_text(request.question[0].name, 300, 'IN', 'A', self.addresses.get(name, '10.0.0.1'))
+        )
+        wire = response.to_wire()
+        if not writer.is_closing():
+            writer.write(len(wire).to_bytes(2, 'big') + wire)
+        return
+
+class Transport(object):
+    """Collects what the listener sends."""
+    def __init__(self):
+        self.sent = []
+        return
+    
+    def sendto(self, data, addr):
+        self.sent.append((bytes(data), addr))
+        return
+
+class ForwarderTestCase(unittest.IsolatedAsyncioTestCase):
+    
+    async def asyncSetUp(self):
+        self.upstream = Upstream()
+        await self.upstream.start()
+        self.pool = forwarder.TCPConnectionPool('127.0.0.1', None, asyncio.get_running_loop(), port=self.upstream.port)
+        self.upstream_timeout = forwarder.UPSTREAM_TIMEOUT
+        return
+    
+    async def asyncTearDown(self):
+        forwarder.UPSTREAM_TIMEOUT = self.upstream_timeout
+        while not self.pool.idle.empty():
+            self.pool.idle.get_nowait().close()
+        await self.upstream.close()
+        return
+    
+    def query(self, name, msg_id):
+        request = dns.message.make_query(name, 'A')
+        request.id = msg_id
+        return request.to_wire()
+    
+    def address(self, response):
+        return dns.message.from_wire(bytes(response)).answer[0][0].address
+
+class TestPool(ForwarderTestCase):
+    """Tests the connection pool."""
+    
+    async def test_demultiplex(self):
+        """Tests that pipelined responses go to the right requests."""
+        self.upstream.addresses['slow.example.'] = '10.0.0.2'
+        self.upstream.delays['slow.example.'] = 0.2
+        self.upstream.addresses['fast.example.'] = '10.0.0.3'
+        slow = asyncio.get_running_loop().create_task(self.pool.query(self.query('slow.example', 1)))
+        await asyncio.sleep(0.05)
+        fast = await self.pool.query(self.query('fast.example', 2))
+        self.assertFalse(slow.done())
+        self.assertEqual(self.address(fast), '10.0.0.3')
+        self.assertEqual(self.address(await slow), '10.0.0.2')
+        self.assertEqual(self.upstream.connections, 1)
+        return
+    
+    async def test_reset(self):
+        """Tests that a request is retried if the connection is closed."""
+        self.upstream.resets.add('reset.example.')
+        response = await self.pool.query(self.query('reset.example', 1))
+        self.assertEqual(self.address(response), '10.0.0.1')
+        self.assertEqual(self.upstream.connections, 2)
+        return
+    
+    async def test_timeout_id_reuse(self):
+        """Tests that a late response isn't given to a later request with the same ID."""
+        forwarder.UPSTREAM_TIMEOUT = 0.2
+        self.upstream.addresses['evil.example.'] = '10.6.6.6'
+        self.upstream.delays['evil.example.'] = 0.3
+        self.upstream.addresses['bank.example.'] = '10.0.0.7'
+        self.upstream.delays['bank.example.'] = 0.15
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.pool.query(self.query('evil.example', 7))
+        response = await self.pool.query(self.query('bank.example', 7))
+        self.assertEqual(self.address(response), '10.0.0.7')
+        return
+
+class TestRespond(ForwarderTestCase):
+    """Tests responding to requests which are forwarded."""
+    
+    async def asyncSetUp(self):
+        await ForwarderTestCase.asyncSetUp(self)
+        self.tempdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tempdir.name, 'superpowers.yaml'), 'w') as f:
+            f.write(CONFIG)
+        self.listener = forwarder.SuperUDPListener()
+        self.listener.event_loop = asyncio.get_running_loop()
+        self.listener.exec_dir = self.tempdir.name
+        self.listener.pool = self.pool
+        self.transport = Transport()
+        self.listener.connection_made(self.transport)
+        self.monotonic = forwarder.monotonic
+        return
+    
+    async def asyncTearDown(self):
+        forwarder.monotonic = self.monotonic
+        self.tempdir.cleanup()
+        await ForwarderTestCase.asyncTearDown(self)
+        return
+    
+    def response(self, i):
+        return dns.message.from_wire(self.transport.sent[i][0])
+    
+    async def test_cache_hit(self):
+        """Tests that a cached response gets the requester's ID and aged TTLs."""
+        await self.listener.respond(self.query('www.example.com', 1), 'one')
+        now = self.monotonic()
+        forwarder.monotonic = lambda: now + 100
+        await self.listener.respond(self.query('www.example.com', 2), 'two')
+        self.assertEqual(self.upstream.queries, ['www.example.com.'])
+        self.assertEqual(self.transport.sent[1][1], 'two')
+        response = self.response(1)
+        self.assertEqual(response.id, 2)
+        self.assertEqual(response.answer[0].ttl, 200)
+        self.assertEqual(self.response(0).answer[0].ttl, 300)
+        return
+    
+    async def test_coalesce(self):
+        """Tests that identical requests in flight share an upstream query."""
+        self.upstream.delays['www.example.com.'] = 0.1
+        await asyncio.gather(
+                self.listener.respond(self.query('www.example.com', 1), 'one'),
+                self.listener.respond(self.query('www.example.com', 2), 'two')
+            )
+        self.assertEqual(self.upstream.queries, ['www.example.com.'])
+        self.assertEqual(sorted( (self.response(i).id, addr) for i, (data, addr) in enumerate(self.transport.sent) ),
+                         [ (1, 'one'), (2, 'two') ])
+        return
+
+    async def test_case(self):
+        """Tests that the case of the question is preserved when sharing responses."""
+        self.upstream.delays['www.example.com.'] = 0.1
+        names = ('www.example.com.', 'WWW.Example.COM.', 'www.EXAMPLE.com.')
+        await asyncio.gather(
+                self.listener.respond(self.query(names[0], 1), 'one'),
+                self.listener.respond(self.query(names[1], 2), 'two')
+            )
+        await self.listener.respond(self.query(names[2], 3), 'three')
+        self.assertEqual(len(self.upstream.queries), 1)
+        for i in range(3):
+            response = self.response(i)
+            self.assertEqual(response.question[0].name.to_text(), names[response.id - 1])
+        return
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
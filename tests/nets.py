@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# Copyright (c) 2021 by Fred Morris Tacoma WA
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+import ipaddress
+
+if '..' not in sys.path:
+    sys.path.insert(0,'..')
+
+from superpowers.nets import Nets, Scope
+
+class TestScope(unittest.TestCase):
+    """Tests scopes."""
+
+    def test_fqdn(self):
+        """Tests that the fallback FQDN is fully qualified."""
+        self.assertEqual(Scope(None, 24, 'last', 'office').fqdn, 'office.')
+        self.assertEqual(Scope(None, 24, 'last', 'office.').fqdn, 'office.')
+        self.assertEqual(Scope(None, 24, 'last').fqdn, '')
+        self.assertEqual(Scope(None, 24, 'last', None).fqdn, '')
+        return
+
+class TestFind(unittest.TestCase):
+    """Tests finding the effective scope for an address."""
+
+    def define_nets(self, *nets):
+        specs = []
+        for net in nets:
+            network = ipaddress.ip_network(net[0])
+            specs.append({ 'net':net[0], 'net_int':int(network.network_address), 'prefixlen':network.prefixlen,
+                           'version':network.version, 'mode':'last', 'fqdn':net[1] })
+        self.nets = Nets([ { 'powers':None, 'nets':specs } ])
+        return
+
+    def find(self, address):
+        scope = self.nets.find(int(ipaddress.ip_address(address)))
+        return scope is not None and scope.fqdn.rstrip('.') or None
+
+    def test_not_found(self):
+        """Tests an address which isn't in any of the nets."""
+        self.define_nets(
+                ('10.0.0.0/24',         'office')
+            )
+        self.assertIsNone(self.find('10.0.1.1'))
+        return
+
+    def test_innermost(self):
+        """Tests that the innermost scope applies."""
+        self.define_nets(
+                ('10.0.0.0/23',         'local'),
+                ('10.0.0.128/25',       'routable'),
+                ('10.0.0.0/25',         'norouting'),
+                ('0.0.0.0/0',           'everything')
+            )
+        self.assertEqual(self.find('10.0.0.200'), 'routable')
+        self.assertEqual(self.find('10.0.0.5'), 'norouting')
+        self.assertEqual(self.find('10.0.1.5'), 'local')
+        self.assertEqual(self.find('192.168.1.1'), 'everything')
+        return
+
+    def test_same_address(self):
+        """Tests nested scopes at the same address."""
+        self.define_nets(
+                ('10.0.0.0/8',          'eight'),
+                ('10.0.0.0/24',         'twentyfour'),
+                ('10.0.0.0',            'host')
+            )
+        self.assertEqual(self.find('10.0.0.0'), 'host')
+        self.assertEqual(self.find('10.0.0.1'), 'twentyfour')
+        self.assertEqual(self.find('10.1.0.0'), 'eight')
+        return
+
+    def test_supersedes(self):
+        """Tests that something declared later at the same address/scope wins."""
+        self.define_nets(
+                ('10.0.0.0/24',         'first'),
+                ('10.0.0.0/24',         'second')
+            )
+        self.assertEqual(self.find('10.0.0.1'), 'second')
+        return
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -88,6 +88,16 @@ class TestQuery(unittest.TestCase):
         self.assertEqual(result, 'example.com')
         return
     
+    def test_all_rules(self):
+        """Tests longest chain, then different domain, then least labels."""
+        self.define_associations(
+                ('1.2.3.4',             ['short.example.net','x.example.com']),
+                ('x.example.com',       ['y.example.com','longname.other.org','o.other.org'])
+            )
+        result = self.superpower.query('1.2.3.4')
+        self.assertEqual(result, 'o.other.org')
+        return
+    
     def test_loop_detection(self):
         """Test ability to detect loops."""
         self.define_associations(
@@ -98,6 +108,74 @@ class TestQuery(unittest.TestCase):
         result = self.superpower.query('1.2.3.4')
         self.assertEqual(result, 'foo.example.com')
         return
+    
+    def test_changed_association(self):
+        """Tests that cached results aren't used once the associations change."""
+        self.superpower.associations.add(shodohflo.DNSArtifact('10.0.0.1;1.2.3.4;dns', 'foo.example.com'), 60)
+        self.assertEqual(self.superpower.query('1.2.3.4'), 'foo.example.com')
+        self.superpower.associations.add(shodohflo.DNSArtifact('10.0.0.1;1.2.3.4;dns', 'bar.example.com'), 60)
+        self.assertEqual(self.superpower.query('1.2.3.4'), 'bar.example.com')
+        return
+
+class TestAssociations(unittest.TestCase):
+    """Tests maintenance of the associations cache."""
+    
+    def setUp(self):
+        self.associations = shodohflo.Associations()
+        self.max_assocs = shodohflo.MAX_ASSOCS
+        shodohflo.MAX_ASSOCS = 3
+        return
+    
+    def tearDown(self):
+        shodohflo.MAX_ASSOCS = self.max_assocs
+        return
+    
+    def add(self, address, *fqdns, ttl=60):
+        self.associations.add(
+            shodohflo.DNSArtifact('10.0.0.1;{};dns'.format(address), ';'.join(fqdns)), ttl
+        )
+        return
+    
+    def test_max_assocs(self):
+        """Tests that the oldest associations are removed first."""
+        for i in range(1,5):
+            self.add('1.2.3.{}'.format(i), 'example.com')
+        self.add('1.2.3.5', 'example.com')
+        self.associations.purge()
+        self.assertEqual(sorted(self.associations.index.keys()), ['1.2.3.3', '1.2.3.4', '1.2.3.5'])
+        return
+    
+    def test_refresh(self):
+        """Tests that refreshing an association keeps it."""
+        for i in range(1,4):
+            self.add('1.2.3.{}'.format(i), 'example.com')
+        self.add('1.2.3.1', 'Example.COM.')
+        self.add('1.2.3.4', 'example.com')
+        self.add('1.2.3.5', 'example.com')
+        self.associations.purge()
+        self.assertEqual(sorted(self.associations.index.keys()), ['1.2.3.1', '1.2.3.4', '1.2.3.5'])
+        self.assertEqual(self.associations.get('1.2.3.1').fqdns, ['example.com'])
+        return
+    
+    def test_expiry(self):
+        """Tests that expired associations are removed."""
+        self.add('1.2.3.1', 'example.com', ttl=-1)
+        self.add('1.2.3.2', 'example.com')
+        self.assertEqual(list(self.associations.index.keys()), ['1.2.3.2'])
+        return
+    
+    def test_merged_artifacts(self):
+        """Tests that merged and copied artifacts can be added."""
+        merged = shodohflo.DNSArtifact.merge(
+                [ shodohflo.DNSArtifact('10.0.0.1;1.2.3.1;dns', 'Foo.example.com.'),
+                  shodohflo.DNSArtifact('10.0.0.2;1.2.3.1;dns', 'bar.example.com') ],
+                None
+            )
+        self.associations.add(merged[0], 60)
+        self.associations.add(shodohflo.CNAMEArtifact('10.0.0.1;WWW.example.com.;cname', 'foo.example.com').copy(), 60)
+        self.assertEqual(sorted(self.associations.get('1.2.3.1').fqdns), ['bar.example.com', 'foo.example.com'])
+        self.assertEqual(self.associations.get('www.example.com').fqdns, ['foo.example.com'])
+        return
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# Copyright (c) 2021 by Fred Morris Tacoma WA
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+import os
+import unittest
+import tempfile
+from sqlite3 import dbapi2 as sqlite3
+
+if '..' not in sys.path:
+    sys.path.insert(0,'..')
+
+import superpowers.sqlite as sqlite
+
+class TestQuery(unittest.TestCase):
+    """Tests the sqlite superpower."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tempdir.name, 'test.db')
+        self.superpower = sqlite.Superpower({'db':self.db_path}, None)
+        return
+
+    def tearDown(self):
+        self.superpower.db.close()
+        self.tempdir.cleanup()
+        return
+
+    def define_addresses(self, *addresses):
+        """Adds addresses to the database with a separate connection."""
+        db = sqlite3.connect(self.db_path)
+        db.executemany("INSERT INTO Address (address, fqdn) VALUES (?, ?)", addresses)
+        db.commit()
+        db.close()
+        return
+
+    def test_not_found(self):
+        """Tests an address which isn't in the database."""
+        self.assertEqual(self.superpower.query('10.0.0.1'), '')
+        return
+
+    def test_reload(self):
+        """Tests that changes are seen after reloading."""
+        self.define_addresses(
+                ('10.0.0.1',    'foo.example.com'),
+                ('10.0.0.2',    None)
+            )
+        self.assertEqual(self.superpower.query('10.0.0.1'), '')
+        self.assertNotEqual(self.superpower.get_data_version(), self.superpower.data_version)
+        self.superpower.reload()
+        self.assertEqual(self.superpower.query('10.0.0.1'), 'foo.example.com')
+        self.assertEqual(self.superpower.query('10.0.0.2'), '')
+        return
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Copyright (c) 2021 by Fred Morris Tacoma WA
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+import unittest
+
+import dns.flags
+import dns.message
+import dns.rrset
+
+if '..' not in sys.path:
+    sys.path.insert(0,'..')
+
+from superpowers import wire
+
+class TestRequestFlags(unittest.TestCase):
+    """Tests the parts of the request which go into the cache key."""
+
+    def test_no_edns(self):
+        """Tests a plain request."""
+        request = dns.message.make_query('example.com', 'A')
+        self.assertEqual(wire.request_flags(request.to_wire()), 0)
+        return
+
+    def test_edns(self):
+        """Tests EDNS, DO and CD."""
+        request = dns.message.make_query('example.com', 'A', use_edns=0)
+        self.assertEqual(wire.request_flags(request.to_wire()), wire.HAS_EDNS)
+        request = dns.message.make_query('example.com', 'A', want_dnssec=True)
+        request.flags |= dns.flags.CD
+        self.assertEqual(wire.request_flags(request.to_wire()),
+                         wire.HAS_EDNS | wire.WANTS_DNSSEC | wire.CHECKING_DISABLED)
+        return
+
+class TestAgeTTLs(unittest.TestCase):
+    """Tests aging cached responses."""
+
+    def test_age_ttls(self):
+        """Tests that TTLs are reduced but not below 0."""
+        request = dns.message.make_query('example.com', 'A', use_edns=0)
+        response = dns.message.make_response(request)
+        response.answer.append(dns.rrset.from_text('example.com.', 300, 'IN', 'A', '10.0.0.1'))
+        response.authority.append(dns.rrset.from_text('example.com.', 60, 'IN', 'NS', 'ns.example.com.'))
+        aged = dns.message.from_wire(bytes(wire.age_ttls(response.to_wire(), 100)))
+        self.assertEqual(aged.answer[0].ttl, 200)
+        self.assertEqual(aged.authority[0].ttl, 0)
+        self.assertEqual(aged.payload, response.payload)
+        return
+
+class TestMakeResponse(unittest.TestCase):
+    """Tests locally generated responses."""
+
+    def make_response(self, request, answer=b'', rcode=0):
+        return dns.message.from_wire(wire.make_response(request.to_wire(), answer, rcode))
+
+    def test_answer(self):
+        """Tests a PTR answer to a request without EDNS."""
+        request = dns.message.make_query('1.0.0.10.in-addr.arpa', 'PTR')
+        response = self.make_response(request, wire.ptr_answer('office.example.com.', 60))
+        self.assertEqual(response.id, request.id)
+        self.assertEqual(response.question, request.question)
+        self.assertEqual(str(response.answer[0][0]), 'office.example.com.')
+        self.assertEqual(response.edns, -1)
+        return
+
+    def test_edns(self):
+        """Tests that the response has an OPT record if the request does."""
+        request = dns.message.make_query('1.0.0.10.in-addr.arpa', 'PTR', use_edns=0)
+        response = self.make_response(request, rcode=3)
+        self.assertEqual(response.rcode(), 3)
+        self.assertEqual(response.edns, 0)
+        self.assertEqual(len(response.answer), 0)
+        return
+
+    def test_flags(self):
+        """Tests that RD and CD are copied from the request."""
+        request = dns.message.make_query('1.0.0.10.in-addr.arpa', 'PTR')
+        request.flags |= dns.flags.CD
+        response = self.make_response(request)
+        self.assertEqual(response.flags, dns.flags.QR | dns.flags.RA | dns.flags.RD | dns.flags.CD)
+        request.flags &= ~(dns.flags.RD | dns.flags.CD)
+        response = self.make_response(request)
+        self.assertEqual(response.flags, dns.flags.QR | dns.flags.RA)
+        return
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)